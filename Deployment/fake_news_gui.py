@@ -225,6 +225,7 @@ en_tokenizer_path = "../Trained_Models/en_tokenizer.pkl"
 bm_model_path = "../Trained_Models/bm_bert_model.h5"
 bm_tokenizer_path = "../Trained_Models/bm_tokenizer"
 bert_model = malaya.transformer.huggingface(model='mesolitica/bert-base-standard-bahasa-cased')
+bert_model.model.eval()
 
 en_model = load_model(en_model_path, custom_objects={'f1_m': f1_m})
 with open(en_tokenizer_path, 'rb') as f:
@@ -235,6 +236,15 @@ bm_tokenizer = AutoTokenizer.from_pretrained(bm_tokenizer_path)
 MAX_SEQ_LENGTH = 512
 
 
+# Round-trip embeddings through the int8 quantization used for the BM training embeddings
+# (quantize_embeddings in BM_Best_Model_BERT.py), so the head sees the same inputs as in training
+def quantize_round_trip(cls_embeddings):
+    scales = cls_embeddings.abs().amax(dim=-1, keepdim=True).clamp_min(1e-6) / 127.0
+    quantized = torch.round(cls_embeddings / scales).to(torch.int8)
+    # Training stores the scales as float16 and dequantizes in float16
+    return quantized.half() * scales.half()
+
+
 # Fake News Classification Function (Integrated)
 def classify_fake_news(samples):
     results = []
@@ -254,19 +264,16 @@ def classify_fake_news(samples):
             probability = float(en_model.predict([padded_title, padded_context])[0][0])
         elif language == Language.MALAY:
             # Concatenate title and context with tagging
-            tagged_input = f"[TITLE] {' '.join(title)} [CONTEXT] {' '.join(context)}"
-            # Tokenize and chunk the input for BERT
-            encoded = bm_tokenizer.encode(tagged_input, add_special_tokens=True, return_tensors="pt")
-            chunks = torch.split(encoded, MAX_SEQ_LENGTH - 2, dim=1)
-            # Generate embeddings for each chunk
-            embeddings = []
-            for chunk in chunks:
-                decoded_chunk = bm_tokenizer.decode(chunk[0].tolist())  # Decode chunk to text
-                chunk_embedding = bert_model.vectorize([decoded_chunk])
-                embeddings.append(chunk_embedding)
-            # Stack embeddings and reshape to match model input
-            embeddings = np.vstack(embeddings)
-            embeddings = np.reshape(embeddings, (len(embeddings), -1, 768))
+            tagged_input = f"[TITLE] {' '.join(title)} [CONTENT] {' '.join(context)}"
+            # Tokenize and chunk the input for BERT the same way as during training
+            encoded = bm_tokenizer(tagged_input, add_special_tokens=True, truncation=True,
+                                   max_length=MAX_SEQ_LENGTH, stride=0, return_overflowing_tokens=True,
+                                   padding=True, return_tensors="pt")
+            # Embed the token ids with the bare BERT encoder (not the masked LM head) and keep each chunk's [CLS]
+            with torch.inference_mode():
+                hidden_states = bert_model.model.bert(input_ids=encoded["input_ids"],
+                                                      attention_mask=encoded["attention_mask"]).last_hidden_state
+            embeddings = quantize_round_trip(hidden_states[:, :1].float()).numpy()  # (chunks, 1, 768)
             # Predict probabilities for all chunks
             probabilities = bm_model.predict(embeddings)
             probability = np.mean(probabilities)
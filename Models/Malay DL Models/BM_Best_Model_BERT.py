@@ -1,11 +1,18 @@
 import os
 import ast
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import tensorflow as tf
+import torch
 import keras_tuner as kt
 import malaya
-from transformers import BertTokenizer
+from transformers import BertTokenizerFast
 from tensorflow.keras import layers
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import EarlyStopping
@@ -18,41 +25,53 @@ from tqdm import tqdm
 # Parameters
 BATCH_SIZE = 8
 MAX_SEQ_LENGTH = 512
+EMBEDDING_DIM = 768
 EPOCHS = 50
+TUNER_EPOCHS = 8
+TUNER_MAX_TRIALS = 30
+DEVICE_CACHE_BYTES = 2 * 1024 ** 3  # Largest float16 embedding set kept in memory and prefetched to the GPU
+CPU_THREADS_PER_WORKER = 4
+# One vectorization worker per GPU, or one per CPU_THREADS_PER_WORKER cores on CPU-only machines
+NUM_VECTORIZE_WORKERS = torch.cuda.device_count() or max(1, (os.cpu_count() or 1) // CPU_THREADS_PER_WORKER)
+BERT_MODEL_NAME = 'mesolitica/bert-base-standard-bahasa-cased'
+
+# Train the attention head in float16, keeping variables and the loss in float32
+tf.keras.mixed_precision.set_global_policy('mixed_float16')
 
 
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
     def __init__(self, initial_learning_rate, warmup_steps, decay_steps):
         super().__init__()
-        self.initial_learning_rate = tf.cast(initial_learning_rate, tf.float32)
-        self.warmup_steps = tf.cast(warmup_steps, tf.float32)
-        self.decay_steps = tf.cast(decay_steps, tf.float32)
+        self.initial_learning_rate = float(initial_learning_rate)
+        self.warmup_steps = float(warmup_steps)
+        self.decay_steps = float(decay_steps)
 
+    @tf.function(jit_compile=True)
     def __call__(self, step):
         step = tf.cast(step, tf.float32)
         # Warmup
-        warmup_pct = tf.minimum(1.0, step / self.warmup_steps)
-        warmup_lr = self.initial_learning_rate * warmup_pct
+        warmup_lr = self.initial_learning_rate * tf.minimum(1.0, step / self.warmup_steps)
         # Decay
-        decay_pct = tf.minimum(1.0, (step - self.warmup_steps) / self.decay_steps)
-        decay_lr = self.initial_learning_rate * (1 - decay_pct)
+        decay_lr = self.initial_learning_rate * tf.maximum(0.0, 1.0 - (step - self.warmup_steps) / self.decay_steps)
         # Combine warmup and decay
         lr = tf.where(step < self.warmup_steps, warmup_lr, decay_lr)
         return tf.maximum(lr, self.initial_learning_rate * 0.1)  # Minimum learning rate
 
     def get_config(self):
         return {
-            "initial_learning_rate": float(self.initial_learning_rate.numpy()),
-            "warmup_steps": int(self.warmup_steps.numpy()),
-            "decay_steps": int(self.decay_steps.numpy())
+            "initial_learning_rate": self.initial_learning_rate,
+            "warmup_steps": int(self.warmup_steps),
+            "decay_steps": int(self.decay_steps)
         }
 
 
 def f1_m(y_true, y_pred):
-    y_pred = tf.round(y_pred)
-    tp = tf.reduce_sum(tf.cast(y_true * y_pred, 'float'), axis=0)
-    fp = tf.reduce_sum(tf.cast((1 - y_true) * y_pred, 'float'), axis=0)
-    fn = tf.reduce_sum(tf.cast(y_true * (1 - y_pred), 'float'), axis=0)
+    # Count matches on boolean masks instead of multiplying float tensors
+    y_true = tf.cast(y_true, tf.bool)
+    y_pred = tf.cast(tf.round(y_pred), tf.bool)
+    tp = tf.cast(tf.math.count_nonzero(y_true & y_pred, axis=0), 'float')
+    fp = tf.cast(tf.math.count_nonzero(~y_true & y_pred, axis=0), 'float')
+    fn = tf.cast(tf.math.count_nonzero(y_true & ~y_pred, axis=0), 'float')
 
     precision = tp / (tp + fp + tf.keras.backend.epsilon())
     recall = tp / (tp + fn + tf.keras.backend.epsilon())
@@ -61,12 +80,13 @@ def f1_m(y_true, y_pred):
 
 
 def model_builder(hp):
-    embedding_input = layers.Input(shape=(None, 768), dtype=tf.float32, name='embedding_input')
+    embedding_input = layers.Input(shape=(None, EMBEDDING_DIM), dtype=tf.float16, name='embedding_input')
 
-    # Multi-head attention
+    # Multi-head attention, with heads * key_dim matching the embedding width
+    num_heads = hp.Choice("num_attention_heads", values=[8, 12])
     attention_layer = layers.MultiHeadAttention(
-        num_heads=hp.Choice("num_attention_heads", values=[4, 6, 8]),
-        key_dim=64,
+        num_heads=num_heads,
+        key_dim=EMBEDDING_DIM // num_heads,
         name="attention"
     )
     attention_output, attention_scores = attention_layer(
@@ -89,7 +109,7 @@ def model_builder(hp):
         )(combined)
         combined = layers.Dropout(hp.Float(f"dropout_{i}", 0.1, 0.3, step=0.1))(combined)
 
-    output = layers.Dense(1, activation='sigmoid', name="classification")(combined)
+    output = layers.Dense(1, activation='sigmoid', dtype='float32', name="classification")(combined)
 
     # Model with attention scores as additional output
     model = Model(inputs=embedding_input, outputs=[output, attention_scores])
@@ -99,49 +119,88 @@ def model_builder(hp):
     model.compile(
         optimizer=optimizer,
         loss="binary_crossentropy",
-        metrics={"classification": [f1_m]}
+        metrics={"classification": [f1_m]},
+        jit_compile=True  # Let XLA fuse attention, pooling and the dense head
     )
     return model
 
 
 # Define tokenization and chunking function
-def tokenize_and_chunk(text, tokenizer, max_length=MAX_SEQ_LENGTH):
-    # Tokenize the text, including special tokens
-    tokenized = tokenizer.encode(text, add_special_tokens=True)
+def tokenize_and_chunk(texts, tokenizer, max_length=MAX_SEQ_LENGTH):
+    # Let the fast tokenizer split every text into [CLS] ... [SEP] chunks in one batched call
+    encoded = tokenizer(
+        texts,
+        add_special_tokens=True,
+        truncation=True,
+        max_length=max_length,
+        stride=0,
+        return_overflowing_tokens=True,
+        return_overflow_to_sample_mapping=True,
+        return_attention_mask=False
+    )
+    input_ids = encoded["input_ids"]
 
-    # Adjust max length to account for [CLS] and [SEP]
-    adjusted_max_length = max_length - 10  # Reserve space for [CLS] and [SEP]
+    # Regroup the flat chunk list per original text using the sample mapping
+    counts = np.bincount(encoded["overflow_to_sample_mapping"], minlength=len(texts))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return [input_ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
 
-    # Chunk the tokenized sequence
-    chunks = [
-        [tokenizer.cls_token_id] + tokenized[i:i + adjusted_max_length] + [tokenizer.sep_token_id]
-        for i in range(0, len(tokenized), adjusted_max_length)
-    ]
-    return chunks
+
+# Parse a column of stored token lists, preferring the much faster JSON decoder
+def parse_token_lists(column):
+    try:
+        return column.map(json.loads)
+    except json.JSONDecodeError:
+        # Datasets exported before Normalization.py wrote JSON store Python list literals
+        return column.map(ast.literal_eval)
 
 
 # Combine the 'Tokenized_Title' and 'Tokenized_Full_Context' columns
-def combine_text(row):
-    tokenized_title = ast.literal_eval(row['Tokenized_Title'])
-    tokenized_full_context = ast.literal_eval(row['Tokenized_Full_Context'])
+def combine_text(data):
     # Add special tokens to differentiate title and content
-    title_text = '[TITLE] ' + ' '.join(tokenized_title)
-    content_text = ' [CONTENT] ' + ' '.join(tokenized_full_context)
+    titles = parse_token_lists(data['Tokenized_Title']).str.join(' ').radd('[TITLE] ')
+    contents = parse_token_lists(data['Tokenized_Full_Context']).str.join(' ').radd(' [CONTENT] ')
     # Combine title and content
-    combined_text = title_text + content_text
-    # Tokenize and chunk combined text
-    chunks = tokenize_and_chunk(combined_text, tokenizer)
-    return chunks
+    combined_texts = (titles + contents).tolist()
+    # Tokenize and chunk all combined texts at once
+    return tokenize_and_chunk(combined_texts, tokenizer)
+
+
+# Describe what the chunk cache was built from, so a changed source or tokenizer invalidates it
+def chunk_cache_metadata(source_path):
+    return {
+        b'source_mtime': repr(os.path.getmtime(source_path)).encode(),
+        b'max_seq_length': str(MAX_SEQ_LENGTH).encode(),
+        b'bert_model_name': BERT_MODEL_NAME.encode()
+    }
+
+
+# Cache the chunked token ids so later runs skip parsing and tokenization
+def save_chunk_cache(data, path, source_path):
+    table = pa.table({
+        'combined_text': pa.array(data['combined_text'].tolist(), type=pa.large_list(pa.large_list(pa.int32()))),
+        'target': pa.array(data['target'].to_numpy(dtype=np.int8))
+    }).replace_schema_metadata(chunk_cache_metadata(source_path))
+    pq.write_table(table, path)
+
+
+# Load the chunk cache, or return None if it is missing or was built from different inputs
+def load_chunk_cache(path, source_path):
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    if any(metadata.get(key) != value for key, value in chunk_cache_metadata(source_path).items()):
+        print("Chunk cache is stale, rebuilding it...")
+        return None
+    return pq.read_table(path).to_pandas()
 
 
 # Flatten chunks into samples
 def flatten_chunks(texts, labels):
-    all_texts = []
-    all_labels = []
-    for text, label in zip(texts, labels):
-        for chunk in text:
-            all_texts.append(chunk)
-            all_labels.append(label)
+    all_texts = list(itertools.chain.from_iterable(texts))
+    # Repeat each label once per chunk of its text
+    chunk_counts = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    all_labels = np.repeat(labels, chunk_counts)
 
     # Ensure matching dimensions
     assert len(all_texts) == len(all_labels), "Mismatch between chunks and labels"
@@ -149,191 +208,353 @@ def flatten_chunks(texts, labels):
 
 
 # Aggregate predictions by averaging probabilities for each original sample
-def aggregate_predictions(text_chunks, predictions):
-    aggregated_predictions = []
-    idx = 0
-    for chunks in text_chunks:
-        num_chunks = len(chunks)  # Number of chunks in this text
-        if num_chunks > 0:
-            aggregated_predictions.append(np.mean(predictions[idx:idx + num_chunks]))
-        else:
-            aggregated_predictions.append(0.0)  # Handle empty chunk case
-        idx += num_chunks
+def aggregate_predictions(chunk_counts, predictions):
+    predictions = np.asarray(predictions, dtype=np.float32).ravel()
+    offsets = np.concatenate(([0], np.cumsum(chunk_counts)[:-1]))
+
+    aggregated_predictions = np.zeros(len(chunk_counts), dtype=np.float32)  # Empty chunk case stays 0.0
+    non_empty = chunk_counts > 0
+    # Sum each text's chunk probabilities as one segment, then divide by the chunk count
+    aggregated_predictions[non_empty] = \
+        np.add.reduceat(predictions, offsets[non_empty]) / chunk_counts[non_empty]
     return aggregated_predictions
 
 
-def vectorize_text(texts, labels, filename, batch_size=100):
-    embeddings = []
-    all_labels = []
-    num_texts = len(texts)
-
-    for i, (text, label) in enumerate(zip(tqdm(texts, desc="Embedding Progress"), labels)):
-        embedding = bert_model.vectorize([tokenizer.decode(text)])
-        embeddings.append(embedding)
-        all_labels.append(label)
-
-        # Save embeddings and labels to disk in batches
-        if (i + 1) % batch_size == 0 or i + 1 == num_texts:
-            # Ensure both embeddings and labels are saved together
-            batch_embeddings = np.array(embeddings, dtype=np.float32)
-            batch_labels = np.array(all_labels, dtype=np.int32)  # Assuming labels are integers
-            with open(filename, "ab") as f:
-                np.save(f, batch_embeddings)
-                np.save(f, batch_labels)
-            embeddings = []  # Clear embeddings
-            all_labels = []  # Clear labels to ensure the next batch starts fresh
-
-    return all_labels
-
-
-def load_embeddings_and_labels(file_path):
-    embeddings = []
-    labels = []
-    with open(file_path, "rb") as f:
-        while True:
-            try:
-                batch_embeddings = np.load(f)
-                batch_labels = np.load(f)
-                embeddings.append(batch_embeddings)
-                labels.append(batch_labels)
-            except EOFError:
-                break
-    return np.concatenate(embeddings, axis=0), np.concatenate(labels, axis=0)
-
-
-# Load Malaya's BERT model
-bert_model = malaya.transformer.huggingface(model='mesolitica/bert-base-standard-bahasa-cased')
-tokenizer = BertTokenizer.from_pretrained('mesolitica/bert-base-standard-bahasa-cased')
-
-# Load and preprocess data
-file_path = os.path.join("..", "Dataset", "Processed_Dataset_BM.csv")
-data = pd.read_csv(file_path)
-data['combined_text'] = data.apply(combine_text, axis=1)
-data['target'] = data['classification_result'].apply(lambda x: 1 if x == 'real' else 0)
-
-# Split dataset
-train_data, test_data = train_test_split(
-    data,
-    test_size=0.2,
-    random_state=42,
-    stratify=data['target']
-)
-
-# Prepare data
-train_texts = train_data['combined_text'].tolist()
-test_texts = test_data['combined_text'].tolist()
-train_labels = train_data['target'].values
-test_labels = test_data['target'].values
-
-# # Flatten chunks to align text chunks with their corresponding labels
-# train_chunks, train_chunk_labels = flatten_chunks(train_texts, train_labels)
-# test_chunks, test_chunk_labels = flatten_chunks(test_texts, test_labels)
-#
-# # Convert chunks into embeddings
-# print("Starting vectorization train dataset...")
-# vectorize_text(train_chunks, train_chunk_labels, "train_bert_embeddings.npy")
-# print("Starting vectorization test dataset...")
-# vectorize_text(test_chunks, test_chunk_labels, "test_bert_embeddings.npy")
-
-# Load saved embeddings and labels
-train_embeddings, train_chunk_labels = load_embeddings_and_labels("train_bert_embeddings.npy")
-test_embeddings, test_chunk_labels = load_embeddings_and_labels("test_bert_embeddings.npy")
-
-# Validate dimensions
-assert len(train_embeddings) == len(train_chunk_labels), \
-    f"Train data mismatch: {len(train_embeddings)} embeddings vs {len(train_chunk_labels)} labels."
-assert len(test_embeddings) == len(test_chunk_labels), \
-    f"Test data mismatch: {len(test_embeddings)} embeddings vs {len(test_chunk_labels)} labels."
-
-# Compute class weights
-class_weights = class_weight.compute_class_weight(
-    class_weight='balanced',
-    classes=np.unique(train_chunk_labels),
-    y=train_chunk_labels
-)
-class_weights = dict(enumerate(class_weights))
-print("Class weights:", class_weights)
-
-# Create datasets
-train_ds = tf.data.Dataset.from_tensor_slices((train_embeddings, train_chunk_labels)) \
-    .shuffle(10000) \
-    .batch(BATCH_SIZE) \
-    .prefetch(tf.data.AUTOTUNE)
-
-test_ds = tf.data.Dataset.from_tensor_slices((test_embeddings, test_chunk_labels)) \
-    .batch(BATCH_SIZE) \
-    .prefetch(tf.data.AUTOTUNE)
-
-# Callbacks
-callbacks = [
-    EarlyStopping(
-        monitor='val_classification_f1_m',
-        patience=5,
-        restore_best_weights=True,
-        mode='max'
+# Pad chunks into a fixed-length int32 token id pool stored as a memmap
+def pad_chunks(chunks, pad_token_id, input_ids_path, max_length=MAX_SEQ_LENGTH):
+    input_ids = np.lib.format.open_memmap(input_ids_path, mode='w+', dtype=np.int32, shape=(len(chunks), max_length))
+    input_ids[:] = pad_token_id
+    for i, chunk in enumerate(chunks):
+        input_ids[i, :len(chunk)] = chunk
+    input_ids.flush()
+    return input_ids
+
+
+# Load Malaya's BERT model onto the given device
+def load_bert_model(device):
+    bert_model = malaya.transformer.huggingface(model=BERT_MODEL_NAME)
+    bert_model.model.to(device).eval()
+    return bert_model
+
+
+# Trim a padded token id batch to its longest chunk and mask out the remaining padding
+def trim_batch(batch, pad_token_id, device):
+    seq_length = int((batch != pad_token_id).sum(axis=1).max())
+    batch_ids = torch.from_numpy(np.ascontiguousarray(batch[:, :seq_length])).to(device).long()
+    return batch_ids, (batch_ids != pad_token_id).long()
+
+
+# Embed token ids with the bare BERT encoder and keep the [CLS] embedding per chunk: (batch, 1, 768)
+def embed_cls(bert_model, batch_ids, batch_mask, device_type):
+    # bert_model.model is a masked LM, so skip its vocabulary head and call the BERT encoder directly
+    with torch.inference_mode(), \
+            torch.autocast(device_type, dtype=torch.float16, enabled=device_type == 'cuda'):
+        hidden_states = bert_model.model.bert(input_ids=batch_ids, attention_mask=batch_mask).last_hidden_state
+    return hidden_states[:, :1].float()
+
+
+# Quantize embeddings to int8 with one symmetric float16 scale per chunk
+# (Deployment/fake_news_gui.py applies the same round trip before serving)
+def quantize_embeddings(cls_embeddings):
+    scales = cls_embeddings.abs().amax(dim=-1, keepdim=True).clamp_min(1e-6) / 127.0
+    return torch.round(cls_embeddings / scales).to(torch.int8), scales.half()
+
+
+# Check on one batch that the trimmed token id pool gives the same [CLS] embeddings
+# as padding the chunks with tokenizer.pad(padding='longest'), like bert_model.vectorize does
+def check_padding_parity(chunks, input_ids_path, tokenizer, batch_size=64, atol=1e-3):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device_type = torch.device(device).type
+    bert_model = load_bert_model(device)
+
+    batch = np.load(input_ids_path, mmap_mode='r')[:batch_size]
+    pool_cls = embed_cls(bert_model, *trim_batch(batch, tokenizer.pad_token_id, device), device_type)
+
+    padded = tokenizer.pad({'input_ids': [[int(t) for t in chunk] for chunk in chunks[:batch_size]]},
+                           padding='longest', return_tensors='pt')
+    reference_cls = embed_cls(bert_model, padded['input_ids'].to(device), padded['attention_mask'].to(device),
+                              device_type)
+
+    max_diff = float((pool_cls - reference_cls).abs().max())
+    assert max_diff <= atol, f"Padded pool [CLS] embeddings differ from tokenizer.pad by {max_diff}"
+    print(f"Padding parity check passed on {len(batch)} chunks (max diff {max_diff:.2e})")
+
+
+# Embed one shard of chunks and write it into its slice of the shared memmaps
+def vectorize_shard(rank, start, end, input_ids_path, pad_token_id, embeddings_path, scales_path,
+                    num_workers, batch_size):
+    # Spread workers over the available GPUs, or split the CPU cores between them
+    if torch.cuda.is_available():
+        device = f'cuda:{rank % torch.cuda.device_count()}'
+    else:
+        device = 'cpu'
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    device_type = torch.device(device).type
+    bert_model = load_bert_model(device)
+
+    input_ids = np.load(input_ids_path, mmap_mode='r')
+    embeddings = np.load(embeddings_path, mmap_mode='r+')
+    scales = np.load(scales_path, mmap_mode='r+')
+
+    for batch_start in tqdm(range(start, end, batch_size), desc=f"Embedding Progress [{rank}]", position=rank):
+        batch_end = min(batch_start + batch_size, end)
+        # Drop the padding columns no chunk in this batch uses
+        batch_ids, batch_mask = trim_batch(input_ids[batch_start:batch_end], pad_token_id, device)
+
+        # Feed token ids straight to the encoder instead of decoding and re-tokenizing
+        cls_embeddings = embed_cls(bert_model, batch_ids, batch_mask, device_type)
+        quantized, batch_scales = quantize_embeddings(cls_embeddings)
+
+        embeddings[batch_start:batch_end] = quantized.cpu().numpy()
+        scales[batch_start:batch_end] = batch_scales.cpu().numpy()
+
+    embeddings.flush()
+    scales.flush()
+
+
+def vectorize_text(input_ids_path, pad_token_id, labels, embeddings_path, scales_path, labels_path,
+                   batch_size=64, num_workers=NUM_VECTORIZE_WORKERS):
+    num_texts = len(np.load(input_ids_path, mmap_mode='r'))
+
+    # Preallocate memory-mapped outputs so every worker writes straight into its own slice
+    embeddings = np.lib.format.open_memmap(
+        embeddings_path, mode='w+', dtype=np.int8, shape=(num_texts, 1, EMBEDDING_DIM)
+    )
+    scales = np.lib.format.open_memmap(scales_path, mode='w+', dtype=np.float16, shape=(num_texts, 1, 1))
+    all_labels = np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int8, shape=(num_texts,))
+    all_labels[:] = labels
+    del embeddings, scales
+    all_labels.flush()
+
+    # Workers read their rows from the token id pool on disk, so only the bounds are sent to them
+    bounds = np.linspace(0, num_texts, num_workers + 1, dtype=np.int64)
+    shards = [
+        (rank, int(start), int(end), input_ids_path, pad_token_id,
+         embeddings_path, scales_path, num_workers, batch_size)
+        for rank, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+    ]
+    if num_workers == 1:
+        vectorize_shard(*shards[0])
+        return
+
+    # Each worker loads its own BERT model, so use spawn to keep CUDA out of forked processes
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(vectorize_shard, *shard) for shard in shards]
+        for future in futures:
+            future.result()
+
+
+def load_embeddings_and_labels(embeddings_path, scales_path, labels_path):
+    return (np.load(embeddings_path, mmap_mode='r'),
+            np.load(scales_path, mmap_mode='r'),
+            np.load(labels_path, mmap_mode='r'))
+
+
+# Restore float16 embeddings from their int8 values and per-chunk scales
+def dequantize(embeddings, scales, labels):
+    return tf.cast(embeddings, tf.float16) * scales, labels
+
+
+# Attach per-sample class weights inside the pipeline, so Keras does not append its own class_weight map
+def add_sample_weights(batch_embeddings, batch_labels, weight_table):
+    if weight_table is None:
+        return batch_embeddings, batch_labels
+    return batch_embeddings, batch_labels, tf.gather(weight_table, tf.cast(batch_labels, tf.int32))
+
+
+# Dequantize a small embedding set once, gather shuffled batches from it and prefetch them to the GPU
+def make_device_dataset(embeddings, scales, labels, shuffle=False, weight_table=None):
+    resident_embeddings = tf.constant(np.ascontiguousarray(embeddings.astype(np.float16) * scales))
+    resident_labels = tf.constant(np.asarray(labels))
+
+    def load_batch(indices):
+        return add_sample_weights(tf.gather(resident_embeddings, indices),
+                                  tf.gather(resident_labels, indices), weight_table)
+
+    # Shuffle indices rather than the embeddings themselves, so no second copy sits in the shuffle buffer
+    dataset = tf.data.Dataset.range(len(labels))
+    if shuffle:
+        dataset = dataset.shuffle(len(labels), reshuffle_each_iteration=True)
+    # prefetch_to_device has to stay the last transformation
+    return dataset.batch(BATCH_SIZE) \
+        .map(load_batch, num_parallel_calls=tf.data.AUTOTUNE) \
+        .apply(tf.data.experimental.prefetch_to_device('/GPU:0'))
+
+
+# Shuffle chunk indices and gather each batch straight from the memory-mapped arrays
+def make_dataset(embeddings, scales, labels, shuffle=False, class_weights=None):
+    num_chunks = len(labels)
+    weight_table = None
+    if class_weights is not None:
+        weight_table = tf.constant([class_weights[c] for c in range(len(class_weights))], dtype=tf.float32)
+    if tf.config.list_physical_devices('GPU') and embeddings.size * 2 <= DEVICE_CACHE_BYTES:
+        return make_device_dataset(embeddings, scales, labels, shuffle=shuffle, weight_table=weight_table)
+
+    def gather(indices):
+        indices = np.sort(indices)  # Read the memmap in ascending order
+        return embeddings[indices], scales[indices], labels[indices]
+
+    def load_batch(indices):
+        batch_embeddings, batch_scales, batch_labels = tf.numpy_function(
+            gather, [indices], [tf.int8, tf.float16, tf.int8]
+        )
+        batch_embeddings.set_shape([None, None, EMBEDDING_DIM])
+        batch_scales.set_shape([None, None, 1])
+        batch_labels.set_shape([None])
+        return add_sample_weights(*dequantize(batch_embeddings, batch_scales, batch_labels), weight_table)
+
+    dataset = tf.data.Dataset.range(num_chunks)
+    if shuffle:
+        dataset = dataset.shuffle(num_chunks, reshuffle_each_iteration=True)
+    return dataset.batch(BATCH_SIZE) \
+        .map(load_batch, num_parallel_calls=tf.data.AUTOTUNE) \
+        .prefetch(tf.data.AUTOTUNE)
+
+
+if __name__ == "__main__":
+    # Load the BERT tokenizer
+    tokenizer = BertTokenizerFast.from_pretrained(BERT_MODEL_NAME)
+
+    # Load and preprocess data
+    file_path = os.path.join("..", "Dataset", "Processed_Dataset_BM.csv")
+    chunk_cache_path = os.path.join("..", "Dataset", "Processed_Dataset_BM_chunks.parquet")
+    data = load_chunk_cache(chunk_cache_path, file_path)
+    if data is None:
+        data = pd.read_csv(file_path)
+        data['combined_text'] = combine_text(data)
+        data['target'] = data['classification_result'].apply(lambda x: 1 if x == 'real' else 0)
+        save_chunk_cache(data, chunk_cache_path, file_path)
+
+    # Split dataset
+    train_data, test_data = train_test_split(
+        data,
+        test_size=0.2,
+        random_state=42,
+        stratify=data['target']
     )
-]
-
-# Initialize the tuner with Hyperband (adaptive, memory-efficient search)
-tuner = kt.Hyperband(
-    model_builder,
-    objective=kt.Objective("val_classification_f1_m", direction='max'),
-    max_epochs=EPOCHS,
-    factor=3,
-    directory="bert_dir",
-    project_name="bert_attention"
-)
-
-# Search for best hyperparameters
-tuner.search(train_ds,
-             validation_data=test_ds,
-             epochs=EPOCHS,
-             callbacks=callbacks,
-             class_weight=class_weights)
-
-# Get the best model hyperparameters
-best_hps = tuner.get_best_hyperparameters(num_trials=1)[0]
-
-# Display the best hyperparameters
-print("Best hyperparameters:", best_hps.values)
-
-# Train the model with best hyperparameters
-model = tuner.hypermodel.build(best_hps)
-history = model.fit(
-    train_ds,
-    validation_data=test_ds,
-    epochs=EPOCHS,
-    callbacks=callbacks,
-    class_weight=class_weights
-)
-
-# Save the model and tokenizer
-model.save("saved_model/bm_bert_with_attention.h5")
-tokenizer.save_pretrained("saved_model/bert_tokenizer")
-
-# Predict probabilities for test chunks
-chunk_predictions = model.predict(test_ds)[0]
-print(f"Prediction output type: {type(chunk_predictions)}")
-print(f"Prediction output lengths: {[len(p) for p in chunk_predictions]}")
-
-print(f"Number of chunks in test_texts: {[len(chunks) for chunks in test_texts]}")
-print(f"Number of predictions: {len(chunk_predictions)}")
-
-for chunks in test_texts:
-    if len(chunks) == 0:
-        print("Empty chunk detected!")
-
-# Aggregate predictions for the original texts
-original_lengths = [len(chunks) for chunks in test_texts]  # Number of chunks per text
-aggregated_predictions = aggregate_predictions(test_texts, chunk_predictions)
-
-# Ensure alignment
-assert len(aggregated_predictions) == len(test_labels), \
-    "Mismatch between predictions and labels during testing."
-
-# Convert probabilities to binary predictions
-final_predictions = np.where(np.array(aggregated_predictions) > 0.5, 1, 0)
-
-# Evaluate F1 score
-f1 = f1_score(test_labels, final_predictions)
-print(f"F1 Score: {f1}")
+
+    # Prepare data
+    train_texts = train_data['combined_text'].tolist()
+    test_texts = test_data['combined_text'].tolist()
+    train_labels = train_data['target'].values
+    test_labels = test_data['target'].values
+
+    # # Flatten chunks to align text chunks with their corresponding labels
+    # train_chunks, train_chunk_labels = flatten_chunks(train_texts, train_labels)
+    # test_chunks, test_chunk_labels = flatten_chunks(test_texts, test_labels)
+    #
+    # # Pad chunks into fixed-length token id pools
+    # pad_chunks(train_chunks, tokenizer.pad_token_id, "train_bert_input_ids.npy")
+    # pad_chunks(test_chunks, tokenizer.pad_token_id, "test_bert_input_ids.npy")
+    #
+    # # Confirm the padded pool embeds like tokenizer.pad(padding='longest') before the full run
+    # check_padding_parity(train_chunks, "train_bert_input_ids.npy", tokenizer)
+    #
+    # # Convert chunks into embeddings
+    # print("Starting vectorization train dataset...")
+    # vectorize_text("train_bert_input_ids.npy", tokenizer.pad_token_id, train_chunk_labels,
+    #                "train_bert_embeddings.npy", "train_bert_scales.npy", "train_bert_labels.npy")
+    # print("Starting vectorization test dataset...")
+    # vectorize_text("test_bert_input_ids.npy", tokenizer.pad_token_id, test_chunk_labels,
+    #                "test_bert_embeddings.npy", "test_bert_scales.npy", "test_bert_labels.npy")
+
+    # Load saved embeddings and labels
+    train_embeddings, train_scales, train_chunk_labels = load_embeddings_and_labels("train_bert_embeddings.npy",
+                                                                                    "train_bert_scales.npy",
+                                                                                    "train_bert_labels.npy")
+    test_embeddings, test_scales, test_chunk_labels = load_embeddings_and_labels("test_bert_embeddings.npy",
+                                                                                 "test_bert_scales.npy",
+                                                                                 "test_bert_labels.npy")
+
+    # Validate dimensions
+    assert len(train_embeddings) == len(train_chunk_labels), \
+        f"Train data mismatch: {len(train_embeddings)} embeddings vs {len(train_chunk_labels)} labels."
+    assert len(test_embeddings) == len(test_chunk_labels), \
+        f"Test data mismatch: {len(test_embeddings)} embeddings vs {len(test_chunk_labels)} labels."
+
+    # Compute class weights
+    class_weights = class_weight.compute_class_weight(
+        class_weight='balanced',
+        classes=np.unique(train_chunk_labels),
+        y=train_chunk_labels
+    )
+    class_weights = dict(enumerate(class_weights))
+    print("Class weights:", class_weights)
+
+    # Create datasets
+    train_ds = make_dataset(train_embeddings, train_scales, train_chunk_labels, shuffle=True,
+                            class_weights=class_weights)
+    test_ds = make_dataset(test_embeddings, test_scales, test_chunk_labels)
+
+    # Callbacks
+    callbacks = [
+        EarlyStopping(
+            monitor='val_classification_f1_m',
+            patience=5,
+            restore_best_weights=True,
+            mode='max'
+        )
+    ]
+
+    # Initialize the tuner with Bayesian optimization; the head trains on cached embeddings,
+    # so a few short epochs per trial are enough to rank candidates
+    tuner = kt.BayesianOptimization(
+        model_builder,
+        objective=kt.Objective("val_classification_f1_m", direction='max'),
+        max_trials=TUNER_MAX_TRIALS,
+        executions_per_trial=1,
+        directory="bert_dir",
+        project_name="bert_attention_bayesian"
+    )
+
+    # Search for best hyperparameters
+    tuner.search(train_ds,
+                 validation_data=test_ds,
+                 epochs=TUNER_EPOCHS,
+                 callbacks=callbacks)
+
+    # Get the best model hyperparameters
+    best_hps = tuner.get_best_hyperparameters(num_trials=1)[0]
+
+    # Display the best hyperparameters
+    print("Best hyperparameters:", best_hps.values)
+
+    # Train the model with best hyperparameters
+    model = tuner.hypermodel.build(best_hps)
+    history = model.fit(
+        train_ds,
+        validation_data=test_ds,
+        epochs=EPOCHS,
+        callbacks=callbacks
+    )
+
+    # Save the model and tokenizer
+    model.save("saved_model/bm_bert_with_attention.h5")
+    tokenizer.save_pretrained("saved_model/bert_tokenizer")
+
+    # Predict probabilities for test chunks
+    chunk_predictions = model.predict(test_ds)[0]
+    print(f"Prediction output type: {type(chunk_predictions)}")
+    print(f"Prediction output shape: {chunk_predictions.shape}")
+
+    # Number of chunks per text
+    chunk_counts = np.fromiter((len(chunks) for chunks in test_texts), dtype=np.int64, count=len(test_texts))
+    print(f"Number of chunks in test_texts: {chunk_counts.tolist()}")
+    print(f"Number of predictions: {len(chunk_predictions)}")
+
+    if (chunk_counts == 0).any():
+        print(f"Empty chunk detected in {np.count_nonzero(chunk_counts == 0)} texts!")
+
+    # Aggregate predictions for the original texts
+    aggregated_predictions = aggregate_predictions(chunk_counts, chunk_predictions)
+
+    # Ensure alignment
+    assert len(aggregated_predictions) == len(test_labels), \
+        "Mismatch between predictions and labels during testing."
+
+    # Convert probabilities to binary predictions
+    final_predictions = (aggregated_predictions > 0.5).astype(np.int8)
+
+    # Evaluate F1 score
+    f1 = f1_score(test_labels, final_predictions)
+    print(f"F1 Score: {f1}")
@@ -1,5 +1,6 @@
 import pandas as pd
 import ast
+import json
 
 # Load the dataset
 df = pd.read_csv('Log/09_Standardized_BM_News.csv')
@@ -23,5 +24,9 @@ def normalize_tokens(tokens):
 df['Tokenized_Title'] = df['Tokenized_Title'].apply(lambda x: normalize_tokens(string_to_list(x)))
 df['Tokenized_Full_Context'] = df['Tokenized_Full_Context'].apply(lambda x: normalize_tokens(string_to_list(x)))
 
+# Store token lists as JSON so downstream scripts can parse them with json.loads
+df['Tokenized_Title'] = df['Tokenized_Title'].map(lambda x: json.dumps(x, ensure_ascii=False))
+df['Tokenized_Full_Context'] = df['Tokenized_Full_Context'].map(lambda x: json.dumps(x, ensure_ascii=False))
+
 # Save the updated DataFrame
 df.to_csv('10_Normalized_BM_News.csv', index=False)